@@ -9,6 +9,7 @@ import argparse
 import os
 import time
 import math
+from functools import partial
 
 # torch imports
 import torch
@@ -65,6 +66,8 @@ parser.add_argument('-v', '--vis', dest='vis', action='store_true',
                     help='Visualize the attention map')
 parser.add_argument('--use-custom-conv', action='store_true',
                     help='Use custom convolution')
+parser.add_argument('--compile', action='store_true',
+                    help='Compile the model (needs torch >= 2.2)')
 parser.add_argument('--gpu', default=0, type=int,
                     help='GPU ID to use.')
 
@@ -84,11 +87,13 @@ def main(args):
           'You will NOT be able to switch between CPU and GPU training!')
 
   # set up the model + loss
+  model_kwargs = {'use_compile': True} if args.compile else {}
   if args.use_custom_conv:
     print("Using custom convolutions in the network")
-    model = default_model(conv_op=CustomConv2d, num_classes=100)
+    model = default_model(conv_op=partial(CustomConv2d, use_custom=True),
+                          num_classes=100, **model_kwargs)
   else:
-    model = default_model(num_classes=100)
+    model = default_model(num_classes=100, **model_kwargs)
   model_arch = "simplenet"
   # model_arch = "simplenet_batchnorm2d"
   # model_arch = "resnet18"
@@ -174,6 +179,9 @@ def main(args):
   if args.resume and args.evaluate:
     print("Testing the model ...")
     cudnn.deterministic = True
+    # fold batch norm into the convs (inference only)
+    if hasattr(model, 'fuse_bn'):
+      model.fuse_bn()
     validate(val_loader, model, -1, args, visualizer=visualizer)
     return
 
@@ -6,8 +6,16 @@ import numpy as np
 import torch
 import torch.nn as nn
 from torch.autograd import Function
+try:
+  from torch.amp import custom_bwd, custom_fwd
+  custom_fwd = custom_fwd(device_type='cuda')
+  custom_bwd = custom_bwd(device_type='cuda')
+except ImportError:
+  # torch < 2.4
+  from torch.cuda.amp import custom_bwd, custom_fwd
 from torch.nn.modules.module import Module
-from torch.nn.functional import fold, unfold
+from torch.utils.checkpoint import checkpoint
+from torch.nn.functional import conv2d, fold, linear, pad
 from torchvision.utils import make_grid
 import math
 from utils import resize_image
@@ -20,9 +28,27 @@ from utils import resize_image
 #################################################################################
 # Part I: Understanding Convolutions
 #################################################################################
+def _unfold_strided(input_feats, kernel_size, stride=1, padding=0):
+  # same as unfold, but the windows are a strided view of the (padded) input,
+  # so only the final reshape to [N, C*K*K, H_o*W_o] touches memory
+  if padding > 0:
+    input_feats = pad(input_feats, [padding] * 4)
+  N, C, H, W = input_feats.size()
+  H_o = (H - kernel_size) // stride + 1
+  W_o = (W - kernel_size) // stride + 1
+  s_n, s_c, s_h, s_w = input_feats.stride()
+  windows = input_feats.as_strided(
+    (N, C, kernel_size, kernel_size, H_o, W_o),
+    (s_n, s_c, s_h, s_w, stride * s_h, stride * s_w))
+  return windows.reshape(N, C * kernel_size * kernel_size, H_o * W_o)
+
 class CustomConv2DFunction(Function):
+  # under autocast, the GEMMs below run in half precision (tensor cores), the
+  # bias is added in fp32, and autograd casts the returned grads back to the
+  # dtypes of the inputs
 
   @staticmethod
+  @custom_fwd
   def forward(ctx, input_feats, weight, bias, stride=1, padding=0):
     """
     Forward propagation of convolution operation.
@@ -63,17 +89,26 @@ class CustomConv2DFunction(Function):
     C_o, C_i = weight.size()[:2]
     H_o = 1 + int((ctx.input_height + 2*padding - kernel_size) // stride)
     W_o = 1 + int((ctx.input_width + 2*padding - kernel_size) // stride)
-    windows = unfold(input_feats, kernel_size, padding=padding, stride=stride)
-    kernels = weight.view(C_o, C_i * kernel_size * kernel_size)
-    output = torch.einsum('ncw,oc->now', windows, kernels).view(-1, C_o, H_o, W_o) \
-            + (bias.view(1,-1,1,1).expand(ctx.batch_size,-1,H_o,W_o))
+    windows = _unfold_strided(input_feats, kernel_size, stride, padding)
+    kernels = weight.reshape(C_o, C_i * kernel_size * kernel_size)
+    # [C_o, CKK] @ [N, CKK, L] -> [N, C_o, L] -> [N, C_o, H_o, W_o]
+    # (the output must not be a view, as in-place ops such as
+    # ReLU(inplace=True) follow the conv)
+    output = torch.matmul(kernels, windows).view(-1, C_o, H_o, W_o)
+    if bias is not None:
+      # out of place, in the bias' precision (fp32 under autocast)
+      output = output + bias.view(1, -1, 1, 1)
+    else:
+      output = output.clone()
 
-    # save for backward (you need to save the unfolded tensor into ctx)
-    ctx.save_for_backward(windows, weight, bias)
+    # save for backward (the unfolded tensor is K*K times larger than the
+    # input, so keep the input and re-unfold it in backward when needed)
+    ctx.save_for_backward(input_feats, weight, bias)
 
     return output
 
   @staticmethod
+  @custom_bwd
   def backward(ctx, grad_output):
     """
     Backward propagation of convolution operation
@@ -88,7 +123,7 @@ class CustomConv2DFunction(Function):
 
     """
     # unpack tensors and initialize the grads
-    windows, weight, bias = ctx.saved_tensors
+    input_feats, weight, bias = ctx.saved_tensors
     grad_input = grad_weight = grad_bias = None
 
     # recover the conv params
@@ -104,21 +139,27 @@ class CustomConv2DFunction(Function):
     #################################################################################
     # compute the gradients w.r.t. input and params
     C_i = weight.size(1)
-    C_o, H_o, W_o = grad_output.size()[1:]
+    C_o = grad_output.size(1)
+    grad_output = grad_output.reshape(batch_size, C_o, -1)
     if ctx.needs_input_grad[0]:
-        grad_windows = torch.einsum('nouv,oiab->niabuv', grad_output, weight)\
-                            .view(batch_size, C_i*kernel_size*kernel_size, -1)
+        # [CKK, C_o] @ [N, C_o, L] -> [N, CKK, L]
+        kernels = weight.reshape(C_o, C_i*kernel_size*kernel_size)
+        grad_windows = torch.matmul(kernels.t(), grad_output)
         grad_input = fold(grad_windows, (input_height, input_width),
                         kernel_size, padding=padding, stride=stride)
     if ctx.needs_input_grad[1]:
-        grad_weight = torch.einsum('nouv,ncuv->oc',
-                                grad_output,
-                                windows.view(batch_size,-1,H_o,W_o))\
+        # (in-place addbmm_ is not autocast, so match grad_output's dtype)
+        windows = _unfold_strided(input_feats.to(grad_output.dtype),
+                                  kernel_size, stride, padding)
+        # batch-reduce GEMM: sum the per-sample [C_o, L] @ [L, CKK] products
+        # into a single [C_o, CKK] output in one call, without flattened copies
+        grad_weight = grad_output.new_zeros(C_o, C_i*kernel_size*kernel_size)\
+                            .addbmm_(grad_output, windows.transpose(1, 2))\
                             .view(C_o,C_i,kernel_size,kernel_size)
 
     if bias is not None and ctx.needs_input_grad[2]:
       # compute the gradients w.r.t. bias (if any)
-      grad_bias = grad_output.sum((0,2,3))
+      grad_bias = grad_output.sum((0,2))
 
     return grad_input, grad_weight, grad_bias, None, None
 
@@ -127,9 +168,11 @@ custom_conv2d = CustomConv2DFunction.apply
 class CustomConv2d(Module):
   """
   The same interface as torch.nn.Conv2D
+  Runs the built-in (cuDNN) conv2d unless use_custom=True, in which case our
+  custom_conv2d op is used
   """
   def __init__(self, in_channels, out_channels, kernel_size, stride=1,
-         padding=0, dilation=1, groups=1, bias=True):
+         padding=0, dilation=1, groups=1, bias=True, use_custom=False):
     super(CustomConv2d, self).__init__()
     assert isinstance(kernel_size, int), "We only support squared filters"
     assert isinstance(stride, int), "We only support equal stride"
@@ -139,6 +182,7 @@ class CustomConv2d(Module):
     self.kernel_size = kernel_size
     self.stride = stride
     self.padding = padding
+    self.use_custom = use_custom
 
     # not used (for compatibility)
     self.dilation = dilation
@@ -162,6 +206,8 @@ class CustomConv2d(Module):
       nn.init.uniform_(self.bias, -bound, bound)
 
   def forward(self, input):
+    if not self.use_custom:
+      return conv2d(input, self.weight, self.bias, self.stride, self.padding)
     # call our custom conv2d op
     return custom_conv2d(input, self.weight, self.bias, self.stride, self.padding)
 
@@ -170,15 +216,115 @@ class CustomConv2d(Module):
        ', stride={stride}, padding={padding}')
     if self.bias is None:
       s += ', bias=False'
+    if self.use_custom:
+      s += ', use_custom=True'
     return s.format(**self.__dict__)
 
 #################################################################################
 # Part II: Design and train a network
 #################################################################################
+def _uses_custom_conv(module):
+  # True if any layer runs our custom conv op (CustomConv2d with use_custom)
+  return any(isinstance(m, CustomConv2d) and m.use_custom
+             for m in module.modules())
+
+def compile_features(features):
+  # compile a feature extractor in place (keeps the state_dict keys) to fuse
+  # the elementwise ops and cut per-layer python overhead. Opt-in via the
+  # models' use_compile flag; stays eager if the installed torch has no
+  # nn.Module.compile or dynamo does not support this platform. Skipped if
+  # any layer runs our custom conv op (autograd.Function). Returns True if
+  # compiled
+  if _uses_custom_conv(features) or not hasattr(features, 'compile'):
+    return False
+  try:
+    import torch._dynamo
+    if not torch._dynamo.is_dynamo_supported():
+      return False
+  except (ImportError, AttributeError):
+    return False
+  features.compile()
+  return True
+
+def use_channels_last(model):
+  # convert the params to channels_last (NHWC), so that cuDNN picks its
+  # fastest kernels; the model's forward converts the input accordingly.
+  # Call before compile_features. Skipped if any layer runs our custom conv op
+  model._channels_last = not _uses_custom_conv(model)
+  if model._channels_last:
+    model.to(memory_format=torch.channels_last)
+  return model
+
+def _last_conv(module):
+  # the conv whose output feeds the next module in a sequential (if any)
+  if isinstance(module, (nn.Conv2d, CustomConv2d, Conv1x1)):
+    return module
+  if isinstance(module, nn.Sequential) and len(module) > 0:
+    return _last_conv(module[-1])
+  return None
+
+def fuse_conv_bn(module):
+  # fold each BatchNorm2d that directly follows a conv inside a sequential
+  # into the conv's weight/bias (using the running stats), and replace the
+  # BN by nn.Identity. Only valid for inference, call it after loading the
+  # weights
+  if isinstance(module, nn.Sequential):
+    for idx in range(1, len(module)):
+      conv, bn = _last_conv(module[idx - 1]), module[idx]
+      if (conv is None) or (not isinstance(bn, nn.BatchNorm2d)) \
+          or (bn.running_var is None):
+        continue
+      with torch.no_grad():
+        scale = torch.rsqrt(bn.running_var + bn.eps)
+        shift = -bn.running_mean * scale
+        if bn.affine:
+          scale = scale * bn.weight
+          shift = shift * bn.weight + bn.bias
+        conv.weight.mul_(scale.view(-1, *([1] * (conv.weight.dim() - 1))))
+        if conv.bias is None:
+          conv.bias = nn.Parameter(shift.clone())
+        else:
+          conv.bias.mul_(scale).add_(shift)
+      module[idx] = nn.Identity()
+  for child in module.children():
+    fuse_conv_bn(child)
+  return module
+
+def _run_layers(layers):
+  def forward(x):
+    for m in layers:
+      x = m(x)
+    return x
+  return forward
+
+def checkpoint_features(features, segments, x):
+  # same as checkpoint_sequential (non-reentrant), except that a segment never
+  # starts with an in-place module, which would overwrite the output of the
+  # previous (checkpointed) segment. The last segment is not checkpointed
+  blocks = []
+  for m in features:
+    if blocks and getattr(m, 'inplace', False):
+      blocks[-1].append(m)
+    else:
+      blocks.append([m])
+  size = int(math.ceil(len(blocks) / float(segments)))
+  chunks = [sum(blocks[i:i + size], []) for i in range(0, len(blocks), size)]
+  for chunk in chunks[:-1]:
+    x = checkpoint(_run_layers(chunk), x, use_reentrant=False)
+  return _run_layers(chunks[-1])(x)
+
 class SimpleNet(nn.Module):
   # a simple CNN for image classifcation
-  def __init__(self, conv_op=nn.Conv2d, num_classes=100):
+  # attack_segments >= 2 checkpoints the features in that many segments during
+  # the PGD steps: less activation memory per step, at the cost of recompute.
+  # 0 disables it (a single segment would checkpoint nothing)
+  def __init__(self, conv_op=nn.Conv2d, num_classes=100, attack_segments=0,
+               use_compile=False):
     super(SimpleNet, self).__init__()
+    assert attack_segments == 0 or attack_segments >= 2, \
+      "attack_segments must be 0 (off) or at least 2"
+    self.attack_segments = attack_segments
+    self._attacking = False
     # you can start from here and create a better model
     self.features = nn.Sequential(
       # conv1 block: 3x conv 3x3
@@ -211,16 +357,33 @@ class SimpleNet(nn.Module):
     # global avg pooling + FC
     self.avgpool =  nn.AdaptiveAvgPool2d((1, 1))
     self.fc = nn.Linear(512, num_classes)
+    use_channels_last(self)
+    # also speeds up the PGD steps, which run self.features num_steps times
+    self._compiled = use_compile and compile_features(self.features)
 
   def forward(self, x):
+    if self._channels_last:
+      x = x.contiguous(memory_format=torch.channels_last)
     # you can implement adversarial training here
     if self.training:
       # generate adversarial sample based on x
       pgd = PGDAttack(nn.CrossEntropyLoss())
       self.training = False
-      x = pgd.perturb(self, x)
-      self.training = True
-    x = self.features(x)
+      self._attacking = True
+      try:
+        x = pgd.perturb(self, x)
+      finally:
+        self._attacking = False
+        self.training = True
+    if self._attacking and self.attack_segments > 0:
+      x = checkpoint_features(self.features, self.attack_segments, x)
+    elif not self._compiled:
+      # call the layers' forward directly, skipping the per-layer
+      # nn.Module.__call__ overhead (hooks on these layers will not fire)
+      for m in self.features:
+        x = m.forward(x)
+    else:
+      x = self.features(x)
     x = self.avgpool(x)
     x = x.view(x.size(0), -1)
     x = self.fc(x)
@@ -299,9 +462,36 @@ def conv3x3(inp, out, stride=1):
   return conv_dw(inp, out, kernel_size=3, stride=stride, padding=1,
                 bias=False)
 
+class Conv1x1(nn.Module):
+  # 1x1 convolution as a single GEMM over all N*H*W pixels. A depthwise 1x1
+  # conv followed by a pointwise one is just a pointwise conv, so only the
+  # pointwise weight is kept
+  def __init__(self, inp, out, stride=1, bias=False):
+    super(Conv1x1, self).__init__()
+    self.stride = stride
+    self.weight = nn.Parameter(torch.Tensor(out, inp))
+    if bias:
+      self.bias = nn.Parameter(torch.Tensor(out))
+    else:
+      self.register_parameter('bias', None)
+    self.reset_parameters()
+
+  def reset_parameters(self):
+    # same as nn.Conv2d / nn.Linear
+    nn.init.kaiming_uniform_(self.weight, a=math.sqrt(5))
+    if self.bias is not None:
+      bound = 1 / math.sqrt(self.weight.size(1))
+      nn.init.uniform_(self.bias, -bound, bound)
+
+  def forward(self, x):
+    if self.stride > 1:
+      x = x[:, :, ::self.stride, ::self.stride]
+    # [N, H, W, C_i] @ [C_i, C_o] (views only, the output stays NHWC in memory)
+    out = linear(x.permute(0, 2, 3, 1), self.weight, self.bias)
+    return out.permute(0, 3, 1, 2)
+
 def conv1x1(inp, out, stride=1):
-  return conv_dw(inp, out, kernel_size=1, padding=0, 
-                stride=stride, bias=False)
+  return Conv1x1(inp, out, stride=stride, bias=False)
 
 def downsample(inp, out, stride):
   return nn.Sequential(
@@ -392,8 +582,11 @@ class LessSimpleNetBN2D_ConvDW(nn.Module):
     # global avg pooling + FC
     self.avgpool =  nn.AdaptiveAvgPool2d((1, 1))
     self.fc = nn.Linear(512, num_classes)
+    use_channels_last(self)
 
   def forward(self, x):
+    if self._channels_last:
+      x = x.contiguous(memory_format=torch.channels_last)
     x = self.features(x)
     x = self.avgpool(x)
     x = x.view(x.size(0), -1)
@@ -460,8 +653,8 @@ class SimpleNetBN2D_ConvDW(nn.Module):
 
 class VGGNet(nn.Module):
   # a simple CNN for image classifcation
-  def __init__(self, conv_op=nn.Conv2d, num_classes=100):
-    super(NotSoSimpleNet, self).__init__()
+  def __init__(self, conv_op=nn.Conv2d, num_classes=100, use_compile=False):
+    super(VGGNet, self).__init__()
     self.features = nn.Sequential(
       #torch.nn.BatchNorm2d(num_features=3, eps=1e-05, momentum=0.1, affine=True, track_running_stats=True)
       nn.BatchNorm2d(3),
@@ -540,8 +733,13 @@ class VGGNet(nn.Module):
     )
     self.avgpool = nn.AdaptiveAvgPool2d((1, 1))
     self.fc=nn.Linear(512,num_classes)
+    use_channels_last(self)
+    if use_compile:
+      compile_features(self.features)
 
   def forward(self, x):
+    if self._channels_last:
+      x = x.contiguous(memory_format=torch.channels_last)
     # you can implement adversarial training here
     # if self.training:
     #   # generate adversarial sample based on x
@@ -553,7 +751,7 @@ class VGGNet(nn.Module):
 
 class MobileNet(nn.Module):
 
-    def __init__(self,conv_op=nn.Conv2d, num_classes=100):
+    def __init__(self,conv_op=nn.Conv2d, num_classes=100, use_compile=False):
         super(MobileNet,self).__init__()
 
         def conv_dw(inp, out , stride): 
@@ -590,13 +788,24 @@ class MobileNet(nn.Module):
                 nn.AvgPool2d(7),
                 )
         self.fc=nn.Linear(512,100)
+        # depthwise convs run much faster with cuDNN's NHWC kernels
+        use_channels_last(self)
+        if use_compile:
+            compile_features(self.features)
         
     def forward(self,x):
+         if self._channels_last:
+             x=x.contiguous(memory_format=torch.channels_last)
          x=self.features(x)
-         x=x.view(x.size(0),-1)
+         x=x.reshape(x.size(0),-1)
          x=self.fc(x)
          return x 
 
+    def fuse_bn(self):
+        # fold BN into the preceding convs for inference
+        fuse_conv_bn(self.features)
+        return self
+
 # change this to your model!
 #default_model = SimpleNet
 #default_model = SimpleNetBN2D_ConvDW
@@ -638,17 +847,29 @@ class PGDAttack(object):
       output: (torch tensor) an adversarial sample of the given network
     """
     # clone the input tensor and disable the gradients
-    output = input.clone()
+    output = input.clone().detach().requires_grad_(True)
     input.requires_grad = False
 
+    # freeze the model params, so the backward passes only compute the
+    # gradients w.r.t. the input (restored after the attack)
+    param_states = [(p, p.requires_grad) for p in model.parameters()]
+    for p, _ in param_states:
+      p.requires_grad_(False)
+
     # loop over the number of steps
-    for _ in range(self.num_steps):
-      output.requires_grad = True
-      pred = model(output)
-      loss = self.loss_fn(pred, torch.argmin(pred, dim=1))
-      loss.backward()
-      output = output - self.step_size * torch.sign(output.grad)
-      output.detach_()
+    try:
+      for _ in range(self.num_steps):
+        pred = model(output)
+        loss = self.loss_fn(pred, torch.argmin(pred, dim=1))
+        loss.backward(inputs=[output])
+        # signed gradient step, in place on the same leaf tensor
+        with torch.no_grad():
+          output.add_(output.grad.sign_(), alpha=-self.step_size)
+        output.grad = None
+    finally:
+      for p, requires_grad in param_states:
+        p.requires_grad_(requires_grad)
+    output = output.detach()
     delta = torch.clamp(output - input, -self.epsilon, self.epsilon)
     output = input + delta
     return output
@@ -692,8 +913,7 @@ class GradAttention(object):
     pred = model(input)
     loss = self.loss_fn(pred, torch.argmax(pred, dim=1))
     loss.backward()
-    output = torch.max(torch.abs(input.grad), 1)[0]\
-                    .view(input.size(0), 1, input.size(2), input.size(3))
+    output = input.grad.abs().amax(dim=1, keepdim=True)
     return output
 
 default_attention = GradAttention
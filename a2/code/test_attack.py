@@ -0,0 +1,46 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import torch
+from student_code import SimpleNet
+
+# set up param here
+num_imgs = 2
+input_size = 64
+segment_counts = [2, 3, 4, 5, 6, 20]
+atol = 1e-05
+
+# let us see what we have
+device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+print("Using device: " + str(device))
+
+def train_step(model, input):
+  # adversarial training runs PGD inside forward
+  model.train()
+  model.zero_grad()
+  output = model(input)
+  output.sum().backward()
+  assert not model._attacking
+  assert all(p.requires_grad for p in model.parameters())
+  return [p.grad.clone() for p in model.parameters()]
+
+input = torch.randn(num_imgs, 3, input_size, input_size, device=device)
+
+# reference: no checkpointing during the PGD steps
+ref_model = SimpleNet().to(device)
+ref_grads = train_step(ref_model, input)
+
+# with attack_segments >= 2 the features are checkpointed during the PGD
+# steps, which must not change the gradients
+print('Check adversarial training with checkpointed PGD ...')
+for segments in segment_counts:
+  model = SimpleNet(attack_segments=segments).to(device)
+  model.load_state_dict(ref_model.state_dict())
+  grads = train_step(model, input)
+  err = max((g - r).abs().max().item() for g, r in zip(grads, ref_grads))
+  if err < atol:
+    print("attack_segments={}: passed".format(segments))
+  else:
+    print("attack_segments={}: failed (max err {})".format(segments, err))
+print('All passed! End of testing.')
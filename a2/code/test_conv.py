@@ -65,6 +65,10 @@ print('Check nn.module wrapper ...')
 
 # instantiate custom conv2d module and test the wrapper
 conv2d_module = CustomConv2d(in_channels, out_channels, kernel_size,
-                             stride=stride, padding=padding).to(device)
+                             stride=stride, padding=padding,
+                             use_custom=True).to(device)
 output = conv2d_module(input_feats.float())
+# the models apply in-place ops (e.g., ReLU) right after the conv
+output = torch.nn.ReLU(inplace=True)(output)
+output.sum().backward()
 print('All passed! End of testing.')